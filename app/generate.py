@@ -190,19 +190,48 @@ from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import os
 import asyncio
+import hashlib
+import importlib.util
+import json
+import httpx
 import logging
+import random
 import re
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from app.llm_cache import LLMCache
+
+# orjson быстрее сериализует ключ кэша; без него используется стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 load_dotenv()
 AI_TOKEN = os.getenv('AI_TOKEN')
 
+# Общий пул соединений: параллельные запросы не ждут друг друга, TLS-рукопожатие выполняется один раз.
+# HTTP/2 включается, только если установлен пакет h2
+_http = httpx.AsyncClient(
+    http2=importlib.util.find_spec('h2') is not None,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
+# Без токена клиент не создается: запросы заведомо вернули бы 401, анализ идет локально
 client = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1",
     api_key=AI_TOKEN,
-)
+    http_client=_http,
+) if AI_TOKEN else None
 
 logger = logging.getLogger(__name__)
 
+if client is None:
+    logger.error("AI_TOKEN не задан - AI анализ отключен, используется локальный")
+
 # Актуальный список работающих бесплатных моделей
 MODELS = [
     "qwen/qwen-2.5-72b-instruct:free",
@@ -211,34 +240,238 @@ MODELS = [
     "meta-llama/llama-3.1-8b-instruct:free",
 ]
 
+# Регулярные выражения компилируются один раз при импорте
+_WS_RE = re.compile(r'\s+')
+_HAS_CYRILLIC_RE = re.compile(r'[\u0400-\u04FF]')
+
+
+class RussianOnlyTable(dict):
+    """Таблица для str.translate: оставляет кириллицу, пробелы, цифры и знаки препинания.
+    Решение для символа вычисляется при первой встрече и запоминается только для BMP."""
+    keep = set('.,!?-:()')
+    # Через таблицу проходит текст пользователя - запоминаются не больше 65536 символов
+    memo_limit = 0x10000
+    
+    def __missing__(self, code: int):
+        char = chr(code)
+        kept = 0x0400 <= code <= 0x04FF or char.isspace() or char.isdecimal() or char in self.keep
+        value = code if kept else None
+        if code < self.memo_limit:
+            self[code] = value
+        return value
+
+# Общая таблица для ответов модели и текста пользователя: ASCII и кириллица заполняются сразу,
+# остальные символы BMP - по мере встречи
+RUSSIAN_ONLY = RussianOnlyTable()
+for _code in (*range(0x80), *range(0x0400, 0x0500)):
+    RUSSIAN_ONLY[_code]
+del _code
+
+
+# Сообщение целиком из приветствий и благодарностей
+_TRIVIAL_RE = re.compile(r'(?:(?:спасибо|благодарю|привет|здравствуйте|пока)\W*)+')
+# Ключевые слова тона сообщения для локального анализа; группа совпадения - категория
+_TONE_RE = re.compile(
+    r'(?P<problem>проблема|сложно|трудно|не знаю)'
+    r'|(?P<question>вопрос|интересно|хочу знать)'
+    r'|(?P<joy>рад|хорошо|отлично|спасибо)'
+)
+# Фрагмент между точками; фрагменты из одних пробелов пропускаются при обходе
+_SENTENCE_RE = re.compile(r'[^.]+')
+_UNIT_SPLIT_RE = re.compile(r'\n{2,}|(?<=[.!?])\s+')
+# Значимые слова для оценки предложений; короткие (предлоги, союзы) не учитываются
+_WORD_RE = re.compile(r'\w{4,}')
+
+# Не больше MODEL_CONCURRENCY одновременных запросов к каждой модели - всплеск не упирается в 429 разом
+MODEL_CONCURRENCY = 4
+_MODEL_LIMITERS = {model: asyncio.Semaphore(MODEL_CONCURRENCY) for model in MODELS}
+# Момент, до которого модель после ошибки не используется
+_MODEL_COOLDOWN = {}
+
+# Общий предел одновременных запросов к API от всех пользователей бота
+_INFLIGHT = asyncio.Semaphore(int(os.getenv('AI_MAX_INFLIGHT', '8')))
+
+# Сколько символов потокового ответа нужно, чтобы проверить язык
+STREAM_CHECK_CHARS = 120
+
+SYSTEM_PROMPT = "Ты помощник для анализа сообщений. Ты должен строго следовать формату ответа. Отвечай ТОЛЬКО на русском языке. Не добавляй ничего от себя. Сохраняй оригинальные местоимения и детали из сообщения."
+# Системное сообщение одно на все запросы - создается один раз
+_SYS_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Неизменные инструкции стоят в начале промпта, текст пользователя - в конце:
+# провайдеры кэшируют совпадающее начало запросов. Инструкции и SYSTEM_PROMPT должны
+# быть одинаковыми байт в байт - не подставляйте в них время, id и другие переменные
+_ANALYZE_INSTRUCTIONS = """Анализируй сообщение и строго следуй формату.
+
+Твоя задача:
+1. ОСНОВНАЯ МЫСЛЬ: [1-2 предложения, выдели главное]
+2. ОТВЕТ: [1-3 предложения, естественный человеческий ответ]
+
+ВАЖНЫЕ ПРАВИЛА ДЛЯ ОТВЕТА:
+- Сохраняй оригинальные местоимения (я/ты/вы/мы) из сообщения
+- Не меняй пол говорящего, если он явно указан
+- Не добавляй информацию, которой нет в сообщении
+- Будь точным в деталях
+- Ответ должен звучать естественно и человечно
+
+ПРАВИЛА ФОРМАТА:
+- Каждая часть должна быть на отдельной строке
+- Начинай с "ОСНОВНАЯ МЫСЛЬ:", затем с новой строки "ОТВЕТ:"
+- Отвечай ТОЛЬКО на русском
+- Не добавляй лишних слов, только указанный формат
+- Ответ должен быть готов для отправки собеседнику"""
+
+_CHUNK_INSTRUCTIONS = """Ниже часть длинного сообщения.
+Кратко, в 1-2 предложениях, перескажи суть этой части.
+Сохраняй оригинальные местоимения и детали. Не добавляй заголовков и ответа.
+Отвечай только на русском."""
+
+_MERGE_INSTRUCTIONS = """Объедини два пересказа соседних частей одного сообщения в один связный пересказ из 1-3 предложений.
+Сохраняй оригинальные местоимения и детали. Отвечай только на русском, без заголовков."""
+
+_REDUCE_INSTRUCTIONS = """Ниже по порядку пересказаны части длинного сообщения.
+Выдели ОСНОВНУЮ мысль всего сообщения и придумай ОТВЕТ.
+
+ВАЖНО:
+- Сохраняй оригинальные местоимения и детали из сообщения
+- Не меняй пол говорящего
+- Будь точным в деталях
+
+Строго соблюдай формат:
+ОСНОВНАЯ МЫСЛЬ: [2-3 предложения]
+ОТВЕТ: [2-4 предложения]
+
+Отвечай только на русском, без лишних слов."""
+
+_UPDATE_INSTRUCTIONS = """Ниже текущий пересказ начала длинного сообщения и его следующая часть.
+Дополни пересказ сутью новой части, чтобы получился один связный пересказ из 2-4 предложений.
+Сохраняй оригинальные местоимения и детали. Отвечай только на русском, без заголовков."""
+
+def build_prompt(instructions: str, text: str) -> str:
+    """Промпт из неизменных инструкций и переменного текста после них"""
+    return f"{instructions}\n\n---\nСообщение:\n{text}"
+
+# Одинаковые запросы (повторы, одинаковые сообщения) не отправляются в API повторно
+llm_cache = LLMCache()
+
+def llm_cache_key(text: str) -> str:
+    """Ключ кэша: SHA-256 от модели, системного промпта и текста запроса"""
+    data = {"model": MODELS[0], "sys": SYSTEM_PROMPT, "user": text}
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+# До этой длины текст анализируется одним запросом - разбиение на части стоит нескольких лишних запросов
+AI_DIRECT_MAX_CHARS = 12000
+# Тексты короче этого порога анализируются без запроса к модели
+TRIVIAL_MAX_CHARS = 80
+# Сколько пересказов частей сводится одним финальным запросом; больше - сначала объединяются попарно
+REDUCE_FANIN = 4
+# До какой длины сжимаются разросшиеся пересказы перед объединением и финальным сведением
+COMPRESS_MAX_CHARS = 3500
+# С этого числа частей пересказ ведется последовательно одной строкой, а не параллельно по частям
+INCREMENTAL_MIN_CHUNKS = int(os.getenv('AI_INCREMENTAL_MIN_CHUNKS', '16'))
+
+def pick_model(attempt: int) -> str:
+    """Первая модель по кругу начиная с attempt, которая не на паузе после ошибки"""
+    now = time.monotonic()
+    for offset in range(len(MODELS)):
+        model = MODELS[(attempt + offset) % len(MODELS)]
+        if _MODEL_COOLDOWN.get(model, 0) < now:
+            return model
+    # На паузе все модели - пробуем по обычному порядку
+    return MODELS[attempt % len(MODELS)]
+
+async def warm_up_client():
+    """Заранее открывает соединение с API, чтобы первый пользователь не ждал рукопожатия"""
+    if client is None:
+        return
+    try:
+        await client.models.list()
+        logger.info("Соединение с AI API установлено")
+    except Exception as e:
+        logger.warning("Не удалось заранее подключиться к AI API: %s", e)
+
+def retry_after_seconds(error: Exception):
+    """Пауза из заголовка Retry-After ответа API (секунды или HTTP-дата), если он есть"""
+    response = getattr(error, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+async def stream_completion(model: str, text: str):
+    """Получает ответ модели потоком. Возвращает None, если начало ответа без кириллицы"""
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=[_SYS_MSG, {"role": "user", "content": text}],
+        timeout=60,
+        max_tokens=800,
+        stream=True
+    )
+    
+    parts = []
+    received = 0
+    checked = False
+    # Поток закрывается при любом выходе, в том числе при ошибке сети посреди ответа -
+    # иначе соединение не вернется в пул
+    async with stream:
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            delta = chunk.choices[0].delta.content
+            parts.append(delta)
+            received += len(delta)
+            
+            # Ответ не на русском видно по первым символам - не ждем всю генерацию
+            if not checked and received >= STREAM_CHECK_CHARS:
+                checked = True
+                if not _HAS_CYRILLIC_RE.search(''.join(parts)):
+                    return None
+    
+    return ''.join(parts)
+
 async def ai_generate(text: str, max_retries=3):
     """Генерация ответа с улучшенной обработкой ошибок"""
+    if client is None:
+        raise Exception("AI_TOKEN не задан")
+    
+    cache_key = llm_cache_key(text)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Ответ модели взят из кэша")
+        return cached
+    
     last_error = None
     
     for attempt in range(max_retries):
-        model = MODELS[attempt % len(MODELS)]
+        model = pick_model(attempt)
         
         try:
-            logger.info(f"Попытка {attempt + 1} с моделью {model}")
-            
-            completion = await client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "Ты помощник для анализа сообщений. Ты должен строго следовать формату ответа. Отвечай ТОЛЬКО на русском языке. Не добавляй ничего от себя. Сохраняй оригинальные местоимения и детали из сообщения."},
-                    {"role": "user", "content": text}
-                ],
-                timeout=60,
-                max_tokens=800
-            )
+            logger.info("Попытка %s с моделью %s", attempt + 1, model)
             
-            result = completion.choices[0].message.content
+            async with _MODEL_LIMITERS[model], _INFLIGHT:
+                result = await stream_completion(model, text)
+            if result is None:
+                logger.warning("Модель %s начала отвечать не на русском, прерываем генерацию", model)
+                continue
             
             # Проверяем, что ответ на русском языке
             if result and len(result.strip()) > 10:
                 # Проверяем наличие кириллицы в ответе
-                if not re.search(r'[а-яА-Я]', result):
-                    logger.warning(f"Ответ не содержит кириллицы, возможно не на русском: {result}")
+                if not _HAS_CYRILLIC_RE.search(result):
+                    logger.warning("Ответ не содержит кириллицы, возможно не на русском: %s", result)
                     continue
+                await llm_cache.set(cache_key, result)
                 return result
             else:
                 raise Exception("Пустой или слишком короткий ответ от модели")
@@ -247,19 +480,34 @@ async def ai_generate(text: str, max_retries=3):
             last_error = e
             error_str = str(e)
             
-            logger.warning(f"Ошибка с моделью {model}: {error_str}")
+            logger.warning("Ошибка с моделью %s: %s", model, error_str)
+            
+            # Упавшую модель какое-то время не пробуем - следующие запросы сразу идут к рабочей
+            if "404" in error_str:
+                cooldown = 60
+            elif "429" in error_str:
+                cooldown = 10
+            else:
+                cooldown = 5
+            _MODEL_COOLDOWN[model] = time.monotonic() + cooldown
             
             if "429" in error_str or "rate" in error_str.lower():
-                wait_time = min(2 ** attempt + 5, 30)
-                logger.info(f"Лимит запросов, ждем {wait_time} секунд")
+                # Сервер сам говорит, сколько ждать; иначе - экспоненциальная пауза со случайной добавкой,
+                # чтобы параллельные запросы не повторялись одновременно
+                retry_after = retry_after_seconds(e)
+                if retry_after is None:
+                    wait_time = min(2 ** attempt, 30) + random.uniform(0, 1)
+                else:
+                    wait_time = min(retry_after, 30)
+                logger.info("Лимит запросов, ждем %.1f секунд", wait_time)
                 await asyncio.sleep(wait_time)
             elif "404" in error_str:
                 await asyncio.sleep(1)
                 continue
             elif "timeout" in error_str.lower():
-                await asyncio.sleep(5)
+                await asyncio.sleep(5 + random.uniform(0, 1))
             else:
-                await asyncio.sleep(2)
+                await asyncio.sleep(2 + random.uniform(0, 1))
     
     raise Exception(f"Не удалось получить ответ после {max_retries} попыток")
 
@@ -268,114 +516,196 @@ def clean_ai_response(text: str) -> str:
     if not text:
         return text
     
-    # Удаляем китайские и другие не-русские символы (кроме пунктуации)
-    cleaned = re.sub(r'[^\u0400-\u04FF\s\.\,\!\?\-\:\(\)\d]', '', text)
+    # Удаляем китайские и другие не-русские символы (кроме пунктуации), затем лишние пробелы;
+    # таблица общая с текстом пользователя и запоминает только символы BMP
+    return _WS_RE.sub(' ', text.translate(RUSSIAN_ONLY)).strip()
+
+def compress_text(text: str, limit: int = COMPRESS_MAX_CHARS) -> str:
+    """Извлекающее сокращение: предложения с самыми частыми в тексте словами, в исходном порядке, до limit символов"""
+    sentences = [unit.strip() for unit in _UNIT_SPLIT_RE.split(text) if unit.strip()]
+    freq = Counter(_WORD_RE.findall(text.lower()))
+    
+    def score(i: int) -> float:
+        words = _WORD_RE.findall(sentences[i].lower())
+        return sum(freq[word] for word in words) / len(words) if words else 0
     
-    # Удаляем лишние пробелы
-    cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+    chosen = []
+    seen = set()
+    size = 0
+    for i in sorted(range(len(sentences)), key=score, reverse=True):
+        # Повторы одного и того же предложения место не занимают
+        if sentences[i] in seen:
+            continue
+        if size + len(sentences[i]) + 1 <= limit:
+            chosen.append(i)
+            seen.add(sentences[i])
+            size += len(sentences[i]) + 1
     
-    return cleaned
+    if not chosen:
+        return text[:limit]
+    return " ".join(sentences[i] for i in sorted(chosen))
 
 async def ai_analyze_message(text: str):
     """Анализирует сообщение и возвращает основную мысль и ответ"""
-    # Для очень длинных текстов делаем умное сокращение
+    # Короткие реплики и одни приветствия/благодарности модель не улучшит - отвечаем локально
+    stripped = text.strip()
+    if client is None or len(stripped) < TRIVIAL_MAX_CHARS or _TRIVIAL_RE.fullmatch(stripped.lower()):
+        return await simple_text_analysis(text)
+    
+    # Обработчики отправляют сюда только тексты до AI_DIRECT_MAX_CHARS; при прямом вызове
+    # с более длинным текстом оставляем самые содержательные предложения в том же бюджете
     original_length = len(text)
-    if original_length > 4000:
-        # Берем начало, середину и конец текста для сохранения контекста
-        part1 = text[:1500]
-        part2 = text[original_length//2 - 500:original_length//2 + 500]
-        part3 = text[-1500:]
-        text = f"{part1}... [пропущена средняя часть] ...{part2}... [пропущена конечная часть] ...{part3}"
-        logger.info(f"Текст сокращен с {original_length} до ~{len(text)} символов")
-    
-    prompt = f"""
-    Анализируй сообщение и строго следуй формату:
-
-    Сообщение: {text}
-
-    Твоя задача:
-    1. ОСНОВНАЯ МЫСЛЬ: [1-2 предложения, выдели главное]
-    2. ОТВЕТ: [1-3 предложения, естественный человеческий ответ]
-
-    ВАЖНЫЕ ПРАВИЛА ДЛЯ ОТВЕТА:
-    - Сохраняй оригинальные местоимения (я/ты/вы/мы) из сообщения
-    - Не меняй пол говорящего, если он явно указан
-    - Не добавляй информацию, которой нет в сообщении
-    - Будь точным в деталях
-    - Ответ должен звучать естественно и человечно
-
-    ПРАВИЛА ФОРМАТА:
-    - Каждая часть должна быть на отдельной строке
-    - Начинай с "ОСНОВНАЯ МЫСЛЬ:", затем с новой строки "ОТВЕТ:"
-    - Отвечай ТОЛЬКО на русском
-    - Не добавляй лишних слов, только указанный формат
-    - Ответ должен быть готов для отправки собеседнику
-    """
+    if original_length > AI_DIRECT_MAX_CHARS:
+        text = compress_text(text, AI_DIRECT_MAX_CHARS)
+        logger.info("Текст сокращен с %s до %s символов", original_length, len(text))
+    
+    prompt = build_prompt(_ANALYZE_INSTRUCTIONS, text)
     
     response = await ai_generate(prompt)
     return clean_ai_response(response)
 
-async def analyze_long_text(text: str):
-    """Анализирует очень длинные тексты с разбиением на части"""
-    if len(text) <= 4000:
-        return await ai_analyze_message(text)
+def chunk_by_paragraph(text: str, limit: int = 3500) -> list:
+    """Делит текст на части до limit символов, не разрывая абзацы и предложения"""
+    chunks = []
+    current = ""
+    for unit in _UNIT_SPLIT_RE.split(text):
+        unit = unit.strip()
+        if not unit:
+            continue
+        if current and len(current) + 1 + len(unit) > limit:
+            chunks.append(current)
+            current = ""
+        # Предложение длиннее лимита все-таки режем по длине
+        while len(unit) > limit:
+            chunks.append(unit[:limit])
+            unit = unit[limit:]
+        current = f"{current} {unit}" if current else unit
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def summarize_chunk(index: int, total: int, chunk: str) -> str:
+    """Кратко пересказывает одну часть длинного текста (только суть, без ответа)"""
+    prompt = build_prompt(_CHUNK_INSTRUCTIONS, f"Часть {index + 1} из {total}:\n{chunk}")
     
-    # Для очень длинных текстов разбиваем на части и анализируем каждую
-    chunk_size = 3500
-    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    response = await ai_generate(prompt)
+    return clean_ai_response(response)
+
+async def map_chunks(chunks: list) -> list:
+    """Пересказывает все части параллельно, сохраняя их порядок"""
+    results = await asyncio.gather(
+        *[summarize_chunk(i, len(chunks), chunk) for i, chunk in enumerate(chunks)],
+        return_exceptions=True
+    )
     
-    if len(chunks) > 3:
-        chunks = chunks[:3]
-        chunks[-1] = chunks[-1] + "... [текст сокращен]"
+    summaries = []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка анализа части %s: %s", i+1, result)
+        elif result:
+            summaries.append(result)
     
-    analyses = []
-    for i, chunk in enumerate(chunks):
-        try:
-            analysis = await ai_analyze_message(f"Часть {i+1} из {len(chunks)}: {chunk}")
-            analyses.append(analysis)
-        except Exception as e:
-            logger.error(f"Ошибка анализа части {i+1}: {e}")
-            analyses.append(f"ОСНОВНАЯ МЫСЛЬ: Не удалось проанализировать часть {i+1}\nОТВЕТ: ")
+    if not summaries:
+        raise Exception("Не удалось получить ответ ни для одной части текста")
+    return summaries
+
+async def merge_summaries(first: str, second: str) -> str:
+    """Объединяет пересказы двух соседних частей в один"""
+    # После неудачных объединений пересказ - склейка нескольких; сжимаем каждую сторону до половины бюджета
+    half = COMPRESS_MAX_CHARS // 2
+    first, second = (compress_text(part, half) if len(part) > half else part for part in (first, second))
+    prompt = build_prompt(_MERGE_INSTRUCTIONS, f"1. {first}\n2. {second}")
     
-    # Объединяем анализы
-    combined_analysis = "\n\n".join(analyses)
+    try:
+        response = await ai_generate(prompt)
+        return clean_ai_response(response)
+    except Exception as e:
+        # Без объединения ничего не теряется - просто передаем оба пересказа дальше
+        logger.error("Ошибка объединения пересказов: %s", e)
+        return f"{first} {second}"
+
+async def reduce_summaries(summaries: list) -> str:
+    """Сводит пересказы частей в итоговый анализ: попарно деревом, пока их больше REDUCE_FANIN"""
+    while len(summaries) > REDUCE_FANIN:
+        merged = await asyncio.gather(
+            *[merge_summaries(summaries[i], summaries[i + 1]) for i in range(0, len(summaries) - 1, 2)]
+        )
+        if len(summaries) % 2:
+            merged.append(summaries[-1])
+        summaries = merged
     
-    # Делаем финальный анализ объединенных результатов
-    final_prompt = f"""
-    Проанализируй объединенные части длинного сообщения:
-
-    {combined_analysis}
-
-    Выдели ОСНОВНУЮ мысль всего сообщения и придумай ОТВЕТ.
-
-    ВАЖНО: 
-    - Сохраняй оригинальные местоимения и детали из сообщения
-    - Не меняй пол говорящего
-    - Будь точным в деталях
-
-    Строго соблюдай формат:
-    ОСНОВНАЯ МЫСЛЬ: [2-3 предложения]
-    ОТВЕТ: [2-4 предложения]
-
-    Отвечай только на русском, без лишних слов.
-    """
+    combined = "\n".join(f"- {summary}" for summary in summaries)
+    # Если объединения не удались, пересказы могут не поместиться - сжимаем так же, как длинный текст
+    if len(combined) > COMPRESS_MAX_CHARS:
+        combined = compress_text(combined)
+    
+    # Делаем финальный анализ по пересказам частей
+    final_prompt = build_prompt(_REDUCE_INSTRUCTIONS, combined)
     
     response = await ai_generate(final_prompt)
     return clean_ai_response(response)
 
+async def incremental_summarize(chunks: list) -> str:
+    """Ведет один пересказ, по очереди дополняя его каждой следующей частью: размер запроса не растет с длиной текста"""
+    summary = await summarize_chunk(0, len(chunks), chunks[0])
+    for i, chunk in enumerate(chunks[1:], start=1):
+        prompt = build_prompt(_UPDATE_INSTRUCTIONS, f"Текущий пересказ:\n{summary}\n\nЧасть {i + 1} из {len(chunks)}:\n{chunk}")
+        try:
+            summary = clean_ai_response(await ai_generate(prompt)) or summary
+        except Exception as e:
+            # Как и при параллельном пересказе, неудачная часть пропускается
+            logger.error("Ошибка анализа части %s: %s", i+1, e)
+    return summary
+
+async def analyze_long_text(text: str):
+    """Анализирует очень длинные тексты: параллельный пересказ частей, затем их сведение"""
+    if client is None or len(text) <= AI_DIRECT_MAX_CHARS:
+        return await ai_analyze_message(text)
+    
+    # Для очень длинных текстов разбиваем на части по границам абзацев и предложений
+    chunks = chunk_by_paragraph(text)
+    
+    # Огромный текст не отправляем сотней параллельных запросов - пересказываем последовательно
+    if len(chunks) >= INCREMENTAL_MIN_CHUNKS:
+        summaries = [await incremental_summarize(chunks)]
+    else:
+        summaries = await map_chunks(chunks)
+    return await reduce_summaries(summaries)
+
+def iter_sentences(text: str):
+    """Непустые предложения (до точки) по одному за линейный проход, без списка всех предложений"""
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group().strip()
+        if sentence:
+            yield sentence
+
+def key_sentences(text: str):
+    """Число непустых предложений и первое, среднее и последнее из них - без списка всех предложений"""
+    total = sum(1 for _ in iter_sentences(text))
+    if total <= 3:
+        return total, []
+    
+    wanted = (0, total // 2, total - 1)
+    key = []
+    for i, sentence in enumerate(iter_sentences(text)):
+        if i in wanted:
+            key.append(sentence)
+    return total, key
+
 async def simple_text_analysis(text: str):
     """Умный резервный анализ без использования AI"""
-    sentences = [s.strip() for s in text.split('.') if s.strip()]
+    total, key = key_sentences(text)
     
-    if len(sentences) > 3:
-        main_idea = sentences[0] + ". " + sentences[len(sentences)//2] + ". " + sentences[-1] + "."
+    if total > 3:
+        main_idea = ". ".join(key) + "."
         
-        # Анализируем тон и содержание сообщения
-        if any(word in text.lower() for word in ['проблема', 'сложно', 'трудно', 'не знаю']):
+        # Анализируем тон и содержание сообщения: все ключевые слова ищутся за один проход
+        tones = {match.lastgroup for match in _TONE_RE.finditer(text.lower())}
+        if 'problem' in tones:
             answer = "Понимаю, что ситуация непростая. Давайте вместе подумаем над решением."
-        elif any(word in text.lower() for word in ['вопрос', 'интересно', 'хочу знать']):
+        elif 'question' in tones:
             answer = "Это действительно интересный вопрос. Я думаю, стоит рассмотреть разные аспекты."
-        elif any(word in text.lower() for word in ['рад', 'хорошо', 'отлично', 'спасибо']):
+        elif 'joy' in tones:
             answer = "Рад это слышать! Продолжайте в том же духе."
         else:
             answer = "Спасибо за развернутое сообщение. Я готов помочь вам разобраться в этом вопросе."
@@ -1,758 +1,164 @@
-# ffmpeg_path = "C:\\ffmpeg\\ffmpeg-master-latest-win64-gpl-shared\\bin\\ffmpeg.exe"
-
-# import os
-# import tempfile
-# import speech_recognition as sr
-# from aiogram import Router, F
-# from aiogram.types import Message
-# from pydub import AudioSegment
-# from pydub.silence import split_on_silence
-# from generate import ai_analyze_message, analyze_long_text, simple_text_analysis
-# import logging
-# import subprocess
-# import hashlib
-# import time
-# from collections import defaultdict
-# import re
-# import asyncio
-
-# router = Router()
-# logger = logging.getLogger(__name__)
-
-# # Кэш и ограничения
-# text_cache = {}
-# user_requests = defaultdict(list)
-# last_ai_error = defaultdict(float)
-
-# def parse_analysis_response(response: str) -> dict:
-#     """Парсит ответ от AI на основную мысль и ответ с улучшенной обработкой"""
-#     if not response:
-#         return {
-#             "main_idea": "Не удалось проанализировать сообщение", 
-#             "answer": "Попробуйте отправить сообщение еще раз"
-#         }
-    
-#     # Очищаем ответ
-#     response = response.strip()
-    
-#     # Случай 1: Ищем стандартный формат с разделением по строкам
-#     lines = response.split('\n')
-#     main_idea = ""
-#     answer = ""
-    
-#     for line in lines:
-#         line = line.strip()
-#         if line.startswith('ОСНОВНАЯ МЫСЛЬ:'):
-#             main_idea = line.replace('ОСНОВНАЯ МЫСЛЬ:', '').strip()
-#         elif line.startswith('ОТВЕТ:'):
-#             answer = line.replace('ОТВЕТ:', '').strip()
-    
-#     # Случай 2: Если нашли оба поля, но они в одной строке
-#     if not answer and 'ОТВЕТ:' in response:
-#         parts = response.split('ОТВЕТ:')
-#         if len(parts) == 2:
-#             main_part = parts[0]
-#             if 'ОСНОВНАЯ МЫСЛЬ:' in main_part:
-#                 main_idea = main_part.split('ОСНОВНАЯ МЫСЛЬ:')[1].strip()
-#             else:
-#                 main_idea = main_part.strip()
-#             answer = parts[1].strip()
-    
-#     # Случай 3: Если все еще не нашли, пытаемся разделить по другим признакам
-#     if not main_idea and not answer:
-#         parts = response.split('\n\n')
-#         if len(parts) >= 2:
-#             main_idea = parts[0]
-#             answer = parts[1]
-#         else:
-#             sentences = [s.strip() for s in response.split('.') if s.strip()]
-#             if len(sentences) >= 2:
-#                 main_idea = '. '.join(sentences[:min(2, len(sentences))]) + '.'
-#                 remaining = sentences[min(2, len(sentences)):]
-#                 if remaining:
-#                     answer = '. '.join(remaining[:min(3, len(remaining))]) + '.'
-#                 else:
-#                     answer = "Интересная история! Расскажите больше подробностей."
-#             else:
-#                 main_idea = response
-#                 answer = "Понимаю вашу ситуацию. Давайте обсудим это подробнее."
-    
-#     # Очищаем от возможных остатков не-русского текста
-#     main_idea = re.sub(r'[^\u0400-\u04FF\s\.\,\!\?\-\:\(\)\d]', '', main_idea)
-#     answer = re.sub(r'[^\u0400-\u04FF\s\.\,\!\?\-\:\(\)\d]', '', answer)
-    
-#     # Удаляем лишние пробелы
-#     main_idea = re.sub(r'\s+', ' ', main_idea).strip()
-#     answer = re.sub(r'\s+', ' ', answer).strip()
-    
-#     # Удаляем возможные остатки меток
-#     for label in ['ОСНОВНАЯ МЫСЛЬ:', 'ОТВЕТ:']:
-#         main_idea = main_idea.replace(label, '').strip()
-#         answer = answer.replace(label, '').strip()
-    
-#     # Проверяем, что поля не пустые
-#     if not main_idea:
-#         main_idea = "Основная мысль не выделена"
-#     if not answer:
-#         answer = "Не удалось сгенерировать ответ"
-    
-#     # Обрезаем слишком длинные ответы
-#     if len(main_idea) > 500:
-#         main_idea = main_idea[:497] + "..."
-#     if len(answer) > 500:
-#         answer = answer[:497] + "..."
-    
-#     return {"main_idea": main_idea, "answer": answer}
-
-# def can_make_ai_request(user_id: int) -> bool:
-#     """Проверяет, можно ли делать запрос к AI"""
-#     now = time.time()
-    
-#     user_requests[user_id] = [req_time for req_time in user_requests[user_id] if now - req_time < 120]
-#     if len(user_requests[user_id]) >= 3:
-#         return False
-    
-#     if now - last_ai_error.get(user_id, 0) < 300:
-#         return False
-    
-#     return True
-
-# def add_request(user_id: int):
-#     """Добавляет запрос в историю пользователя"""
-#     user_requests[user_id].append(time.time())
-
-# def mark_ai_error(user_id: int):
-#     """Отмечает ошибку AI для пользователя"""
-#     last_ai_error[user_id] = time.time()
-
-# def split_audio_on_silence(audio_path, silence_thresh=-40, min_silence_len=1000, chunk_length=30000):
-#     """
-#     Разбивает аудио на сегменты по тишине или по времени
-#     """
-#     try:
-#         # Загружаем аудио
-#         audio = AudioSegment.from_wav(audio_path)
-#         duration = len(audio)
-        
-#         # Если аудио короткое, возвращаем как есть
-#         if duration <= 45000:  # 45 секунд
-#             return [audio]
-        
-#         # Сначала пытаемся разбить по тишине
-#         chunks = split_on_silence(
-#             audio,
-#             min_silence_len=min_silence_len,
-#             silence_thresh=silence_thresh,
-#             keep_silence=500  # Оставляем немного тишины для естественности
-#         )
-        
-#         # Если разбиение по тишине не дало результатов или слишком много/мало чанков,
-#         # разбиваем по фиксированному времени
-#         if not chunks or len(chunks) > 20 or len(chunks) < 2:
-#             chunks = []
-#             for i in range(0, duration, chunk_length):
-#                 chunk = audio[i:i + chunk_length]
-#                 if len(chunk) > 1000:  # Минимальная длина чанка 1 секунда
-#                     chunks.append(chunk)
-        
-#         logger.info(f"Аудио разбито на {len(chunks)} сегментов, общая длительность: {duration}мс")
-#         return chunks
-        
-#     except Exception as e:
-#         logger.error(f"Ошибка при разбиении аудио: {e}")
-#         # В случае ошибки возвращаем весь файл как один чанк
-#         return [AudioSegment.from_wav(audio_path)]
-
-# async def recognize_long_audio(wav_filename):
-#     """Распознает длинные аудио файлы, разбивая их на сегменты"""
-#     recognizer = sr.Recognizer()
-#     full_text = ""
-    
-#     try:
-#         # Разбиваем аудио на сегменты
-#         chunks = split_audio_on_silence(wav_filename)
-        
-#         if len(chunks) > 1:
-#             logger.info(f"Обрабатываю {len(chunks)} сегментов аудио")
-        
-#         for i, chunk in enumerate(chunks):
-#             # Создаем временный файл для сегмента
-#             with tempfile.NamedTemporaryFile(delete=False, suffix=f'_segment_{i}.wav') as segment_file:
-#                 segment_filename = segment_file.name
-            
-#             # Экспортируем сегмент
-#             chunk.export(segment_filename, format="wav")
-            
-#             try:
-#                 # Распознаем сегмент
-#                 with sr.AudioFile(segment_filename) as source:
-#                     recognizer.adjust_for_ambient_noise(source, duration=0.5)
-#                     audio_data = recognizer.record(source)
-#                     segment_text = recognizer.recognize_google(audio_data, language='ru-RU')
-                    
-#                     if segment_text:
-#                         full_text += segment_text + " "
-#                         logger.info(f"Сегмент {i+1}/{len(chunks)} распознан: {segment_text[:50]}...")
-#                     else:
-#                         logger.warning(f"Сегмент {i+1} не распознан")
-                        
-#             except sr.UnknownValueError:
-#                 logger.warning(f"Не удалось распознать сегмент {i+1}")
-#             except Exception as e:
-#                 logger.error(f"Ошибка при распознавании сегмента {i+1}: {e}")
-#             finally:
-#                 # Удаляем временный файл сегмента
-#                 if os.path.exists(segment_filename):
-#                     os.unlink(segment_filename)
-        
-#         return full_text.strip()
-        
-#     except Exception as e:
-#         logger.error(f"Ошибка при распознавании длинного аудио: {e}")
-#         # Пробуем распознать как обычное короткое аудио
-#         try:
-#             with sr.AudioFile(wav_filename) as source:
-#                 recognizer.adjust_for_ambient_noise(source, duration=0.5)
-#                 audio_data = recognizer.record(source)
-#                 return recognizer.recognize_google(audio_data, language='ru-RU')
-#         except:
-#             return ""
-
-# @router.message(F.voice)
-# async def handle_voice_message(message: Message):
-#     """Обработка голосовых сообщений с поддержкой длинных записей"""
-#     user_id = message.from_user.id
-    
-#     if not can_make_ai_request(user_id):
-#         await message.answer("⏳ Слишком много запросов. Подождите 2-3 минуты.")
-#         return
-    
-#     add_request(user_id)
-    
-#     # Проверяем длину голосового сообщения
-#     voice_duration = message.voice.duration
-#     if voice_duration > 120:
-#         await message.answer(f"🎤 Обрабатываю длинное голосовое сообщение ({voice_duration} сек)... Это может занять некоторое время.")
-#     else:
-#         await message.answer("🎤 Обрабатываю голосовое сообщение...")
-    
-#     ogg_filename = None
-#     wav_filename = None
-    
-#     try:
-#         voice = message.voice
-#         file = await message.bot.get_file(voice.file_id)
-#         file_path = file.file_path
-        
-#         # Создаем временные файлы
-#         with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as ogg_file:
-#             ogg_filename = ogg_file.name
-        
-#         with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as wav_file:
-#             wav_filename = wav_file.name
-        
-#         # Скачиваем файл
-#         await message.bot.download_file(file_path, ogg_filename)
-        
-#         if not os.path.exists(ogg_filename) or os.path.getsize(ogg_filename) == 0:
-#             await message.answer("❌ Не удалось скачать голосовое сообщение")
-#             return
-        
-#         # Конвертируем OGG в WAV
-#         ffmpeg_path = "C:\\ffmpeg\\ffmpeg-master-latest-win64-gpl-shared\\bin\\ffmpeg.exe"
-        
-#         if not os.path.exists(ffmpeg_path):
-#             await message.answer("❌ FFmpeg не найден")
-#             return
-        
-#         try:
-#             result = subprocess.run([
-#                 ffmpeg_path,
-#                 '-i', ogg_filename,
-#                 '-acodec', 'pcm_s16le',
-#                 '-ac', '1',
-#                 '-ar', '16000',
-#                 '-af', 'volume=1.5,highpass=f=200,lowpass=f=3000',
-#                 wav_filename,
-#                 '-y'
-#             ], capture_output=True, text=True, timeout=60)
-            
-#             if result.returncode != 0:
-#                 await message.answer("❌ Ошибка конвертации аудио")
-#                 return
-                
-#         except subprocess.TimeoutExpired:
-#             await message.answer("❌ Таймаут конвертации аудио")
-#             return
-        
-#         # Проверяем что WAV файл создан
-#         if not os.path.exists(wav_filename) or os.path.getsize(wav_filename) == 0:
-#             await message.answer("❌ Не удалось конвертировать аудио")
-#             return
-        
-#         # Распознаем аудио
-#         text = await recognize_long_audio(wav_filename)
-        
-#         if not text or len(text.strip()) < 5:
-#             await message.answer("❌ Не удалось распознать речь в сообщении")
-#             return
-        
-#         text_length = len(text)
-
-#         # ОБНОВЛЕНИЕ: Разбиваем длинный текст на части для отправки
-#         if text_length > 4000:
-#             chunks = split_long_text(text)
-#             await message.answer(f"📝 Распознанный текст ({text_length} символов, отправляется {len(chunks)} частями):")
-            
-#             # Отправляем части с задержкой между сообщениями
-#             for i, chunk in enumerate(chunks):
-#                 # Добавляем номер части к каждому сообщению
-#                 part_text = f"**Часть {i+1}/{len(chunks)}:**\n{chunk}"
-                
-#                 # Дополнительная проверка длины
-#                 if len(part_text) > 4096:
-#                     # Если все равно слишком длинное, разбиваем еще мельче
-#                     sub_chunks = split_long_text(chunk, max_length=2000)
-#                     for j, sub_chunk in enumerate(sub_chunks):
-#                         sub_part_text = f"**Часть {i+1}.{j+1}:**\n{sub_chunk}"
-#                         await message.answer(sub_part_text)
-#                         await asyncio.sleep(0.5)  # Задержка между сообщениями
-#                 else:
-#                     await message.answer(part_text)
-#                     await asyncio.sleep(0.5)  # Задержка между сообщениями
-#         else:
-#             await message.answer(f"📝 Распознанный текст ({text_length} символов):\n{text}")
-        
-#         # Проверяем кэш
-#         text_hash = hashlib.md5(text.encode()).hexdigest()
-#         if text_hash in text_cache:
-#             analysis = text_cache[text_hash]
-#             await message.answer("♻️ Использую кэшированный результат")
-#         else:
-#             # Пытаемся использовать AI для анализа
-#             try:
-#                 # Выбираем метод анализа в зависимости от длины текста
-#                 if text_length > 4000:
-#                     await message.answer("📖 Текст длинный, анализирую по частям...")
-#                     analysis_response = await analyze_long_text(text)
-#                 else:
-#                     analysis_response = await ai_analyze_message(text)
-                
-#                 # Логируем сырой ответ от AI для отладки
-#                 logger.info(f"Сырой ответ от AI: {analysis_response}")
-                
-#                 analysis = parse_analysis_response(analysis_response)
-#                 text_cache[text_hash] = analysis
-                
-#                 # Очищаем старые записи кэша
-#                 if len(text_cache) > 50:
-#                     oldest_key = next(iter(text_cache))
-#                     text_cache.pop(oldest_key)
-                    
-#             except Exception as e:
-#                 logger.error(f"AI анализ не удался: {e}")
-#                 mark_ai_error(user_id)
-#                 # Используем резервный анализ
-#                 backup_response = await simple_text_analysis(text)
-#                 analysis = parse_analysis_response(backup_response)
-#                 await message.answer("⚠️ Использую локальный анализ (AI временно недоступен)")
-        
-#         # Сначала отправляем основную мысль
-#         await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-        
-#         # Затем отправляем заголовок "Готовый ответ для отправки"
-#         await message.answer("💬 **Готовый ответ для отправки:**")
-        
-#         # Затем отправляем сам ответ отдельным сообщением
-#         await message.answer(analysis['answer'])
-        
-#     except sr.RequestError as e:
-#         await message.answer("❌ Ошибка сервиса распознавания речи.")
-#         logger.error(f"Speech recognition error: {e}")
-#     except Exception as e:
-#         error_msg = str(e)
-#         logger.error(f"Voice processing error: {e}")
-        
-#         if "429" in error_msg or "rate" in error_msg.lower():
-#             mark_ai_error(user_id)
-#             await message.answer("❌ Лимиты AI исчерпаны. Попробуйте через 5-10 минут.")
-#         elif "Не удалось получить ответ" in error_msg:
-#             mark_ai_error(user_id)
-#             await message.answer("❌ Сервис AI временно недоступен. Использую локальный анализ.")
-#             try:
-#                 # Используем резервный анализ
-#                 backup_response = await simple_text_analysis(text)
-#                 analysis = parse_analysis_response(backup_response)
-#                 await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-#                 await message.answer("💬 **Готовый ответ для отправки:**")
-#                 await message.answer(analysis['answer'])
-#             except:
-#                 await message.answer("❌ Не удалось обработать сообщение.")
-#         elif "message is too long" in error_msg.lower():
-#             # Обработка слишком длинных сообщений - разбиваем на части
-#             chunks = split_long_text(text)
-#             await message.answer("📝 Распознанный текст (отправляется частями):")
-#             for i, chunk in enumerate(chunks):
-#                 await message.answer(f"**Часть {i+1}/{len(chunks)}:**\n{chunk}")
-#         else:
-#             await message.answer(f"❌ Ошибка обработки: {error_msg}")
-#     finally:
-#         # Удаляем временные файлы
-#         for filename in [ogg_filename, wav_filename]:
-#             if filename and os.path.exists(filename):
-#                 try:
-#                     os.unlink(filename)
-#                 except Exception as e:
-#                     logger.warning(f"Не удалось удалить файл {filename}: {e}")
-
-# @router.message(F.text & ~F.command)
-# async def handle_text_message(message: Message):
-#     """Обработка текстовых сообщений с поддержкой длинных текстов"""
-#     user_id = message.from_user.id
-#     text = message.text
-    
-#     if not can_make_ai_request(user_id):
-#         await message.answer("⏳ Слишком много запросов. Подождите 2-3 минуты.")
-#         return
-    
-#     add_request(user_id)
-    
-#     text_length = len(text)
-    
-#     # Уведомление о длинном тексте
-#     if text_length > 4000:
-#         await message.answer(f"📖 Обрабатываю длинный текст ({text_length} символов)... Это может занять некоторое время.")
-#     else:
-#         await message.answer("🤔 Анализирую текст...")
-    
-#     try:
-#         # Проверяем кэш
-#         text_hash = hashlib.md5(text.encode()).hexdigest()
-#         if text_hash in text_cache:
-#             analysis = text_cache[text_hash]
-#             await message.answer("♻️ Использую кэшированный результат")
-#         else:
-#             # Пытаемся использовать AI для анализа
-#             try:
-#                 # Выбираем метод анализа в зависимости от длины текста
-#                 if text_length > 4000:
-#                     analysis_response = await analyze_long_text(text)
-#                 else:
-#                     analysis_response = await ai_analyze_message(text)
-                
-#                 # Логируем сырой ответ от AI для отладки
-#                 logger.info(f"Сырой ответ от AI (текст): {analysis_response}")
-                
-#                 analysis = parse_analysis_response(analysis_response)
-#                 text_cache[text_hash] = analysis
-#             except Exception as e:
-#                 logger.error(f"AI анализ не удался: {e}")
-#                 mark_ai_error(user_id)
-#                 # Используем резервный анализ
-#                 backup_response = await simple_text_analysis(text)
-#                 analysis = parse_analysis_response(backup_response)
-#                 await message.answer("⚠️ Использую локальный анализ (AI временно недоступен)")
-#             except Exception as e:
-#                 error_msg = str(e)
-#                 logger.error(f"Text processing error: {e}")
-                
-#                 if "429" in error_msg or "rate" in error_msg.lower():
-#                     mark_ai_error(user_id)
-#                     await message.answer("❌ Лимиты AI исчерпаны. Попробуйте через 5-10 минут.")
-#                 elif "Не удалось получить ответ" in error_msg:
-#                     mark_ai_error(user_id)
-#                     await message.answer("❌ Сервис AI временно недоступен.")
-#                 elif "message is too long" in error_msg.lower():
-#                     # Если ответ слишком длинный, разбиваем его на гарантированно маленькие части
-#                     response_text = f"🎯 **Основная мысль:**\n{analysis['main_idea']}\n\n💬 **Готовый ответ для отправки:**\n{analysis['answer']}"
-#                     chunks = split_long_text(response_text, max_length=1500)
-#                     for chunk in chunks:
-#                         await message.answer(chunk[:4096])  # Дополнительная защита
-#                         await asyncio.sleep(0.3)
-#                 else:
-#                     await message.answer(f"❌ Ошибка при анализе сообщения: {error_msg}")
-        
-#         # Сначала отправляем основную мысль
-#         await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-        
-#         # Затем отправляем заголовок "Готовый ответ для отправки"
-#         await message.answer("💬 **Готовый ответ для отправки:**")
-        
-#         # Затем отправляем сам ответ отдельным сообщением
-#         await message.answer(analysis['answer'])
-        
-#     except Exception as e:
-#         error_msg = str(e)
-#         logger.error(f"Text processing error: {e}")
-        
-#         if "429" in error_msg or "rate" in error_msg.lower():
-#             mark_ai_error(user_id)
-#             await message.answer("❌ Лимиты AI исчерпаны. Попробуйте через 5-10 минут.")
-#         elif "Не удалось получить ответ" in error_msg:
-#             mark_ai_error(user_id)
-#             await message.answer("❌ Сервис AI временно недоступен.")
-#         elif "message is too long" in error_msg.lower():
-#         # Обработка слишком длинных сообщений - разбиваем на части с улучшенной логикой
-#             chunks = split_long_text(text, max_length=2000)
-#             await message.answer(f"📝 Распознанный текст ({len(text)} символов, отправляется {len(chunks)} частями):")
-            
-#             for i, chunk in enumerate(chunks):
-#                 part_text = f"**Часть {i+1}/{len(chunks)}:**\n{chunk}"
-                
-#                 # Двойная проверка длины
-#                 if len(part_text) > 4096:
-#                     # Экстренное разбиение
-#                     emergency_chunks = [part_text[j:j+2000] for j in range(0, len(part_text), 2000)]
-#                     for emergency_chunk in emergency_chunks:
-#                         await message.answer(emergency_chunk[:4096])
-#                         await asyncio.sleep(0.5)
-#                 else:
-#                     await message.answer(part_text)
-#                     await asyncio.sleep(0.5)
-#         else:
-#             await message.answer(f"❌ Ошибка при анализе сообщения: {error_msg}")
-
-# @router.message(F.command("start"))
-# async def start_command(message: Message):
-#     """Обработка команды /start"""
-#     welcome_text = """
-# 🤖 **Бот-анализатор сообщений**
-
-# Отправьте мне:
-# • 📝 Текстовое сообщение (ЛЮБОЙ длины)
-# • 🎤 Голосовое сообщение (ЛЮБОЙ длины)
-
-# Я:
-# 1. 📝 Распознаю текст (для голосовых)
-# 2. 🎯 Выделю основную мысль  
-# 3. 💬 Предложу готовый ответ
-
-# ✨ **Особенности:**
-# - ✅ Поддержка ОЧЕНЬ длинных сообщений
-# - ✅ Автоматическое разбиение на части
-# - ✅ Точное сохранение деталей
-# - ✅ Удобное копирование ответов
-
-# ⚠️ *Ограничения:*
-# - Максимум 3 запросов в 2 минуты
-# - При ошибках AI используется локальный анализ
-
-# 💡 *Советы:*
-# - Можно отправлять сообщения любой длины!
-# - Бот сам разобьет длинные тексты на части
-# - Ответы отправляются отдельными сообщениями для удобства
-#     """
-#     await message.answer(welcome_text)
-
-# @router.message(F.command("help"))
-# async def help_command(message: Message):
-#     """Помощь по использованию бота"""
-#     help_text = """
-# 📋 **Как использовать бота:**
-
-# 💬 *Текстовые сообщения:*
-# - Просто напишите сообщение любой длины
-# - Бот выделит основную мысль и предложит готовый ответ
-
-# 🎤 *Голосовые сообщения:*
-# - Отправьте голосовое сообщение любой длины
-# - Бот распознает речь и проанализирует содержание
-
-# 📊 *Что вы получите:*
-# 1. **Распознанный текст** (для голосовых)
-# 2. **Основную мысль** - краткое содержание сообщения  
-# 3. **Готовый ответ** - отдельным сообщением, легко копируется
-
-# ⚡ *Ограничения:*
-# - Максимум 3 запроса каждые 2 минуты
-# - При ошибках AI используется упрощенный анализ
-
-# 🛠 *Команды:*
-# /start - начать работу
-# /help - эта справка
-# /status - статус системы
-# /clear_cache - очистить кэш
-#     """
-#     await message.answer(help_text)
-
-# @router.message(F.command("status"))
-# async def status_command(message: Message):
-#     """Показывает статус лимитов"""
-#     user_id = message.from_user.id
-#     now = time.time()
-    
-#     # Статус запросов
-#     recent_requests = [req_time for req_time in user_requests[user_id] if now - req_time < 120]
-#     remaining_requests = max(0, 3 - len(recent_requests))
-    
-#     # Статус AI
-#     ai_blocked = now - last_ai_error.get(user_id, 0) < 300
-#     ai_status = "🔴 Временно отключен" if ai_blocked else "🟢 Доступен"
-    
-#     status_text = f"""
-# 📊 **Статус системы:**
-
-# 🔄 Запросы: {len(recent_requests)}/3 (осталось: {remaining_requests})
-# 🤖 AI: {ai_status}
-# 💾 Кэш: {len(text_cache)} записей
-
-# {"⏳ AI будет доступен через " + str(int(300 - (now - last_ai_error[user_id]))) + " сек" if ai_blocked else "✅ Все системы работают"}
-#     """
-#     await message.answer(status_text)
-
-# @router.message(F.command("clear_cache"))
-# async def clear_cache_command(message: Message):
-#     """Очищает кэш"""
-#     text_cache.clear()
-#     await message.answer("✅ Кэш очищен")
-
-# @router.message(F.command("reset_limits"))
-# async def reset_limits_command(message: Message):
-#     """Сбрасывает лимиты для пользователя (для тестирования)"""
-#     user_id = message.from_user.id
-#     user_requests[user_id] = []
-#     last_ai_error[user_id] = 0
-#     await message.answer("✅ Лимиты сброшены")
-
-# def split_long_text(text: str, max_length: int = 3900) -> list:
-#     """Разбивает длинный текст на части для отправки в Telegram"""
-#     if len(text) <= max_length:
-#         return [text]
-    
-#     chunks = []
-#     current_chunk = ""
-    
-#     # Разбиваем текст на предложения
-#     sentences = re.split(r'([.!?]+[\s]*)', text)
-    
-#     # Объединяем разделители с предложениями
-#     sentences_combined = []
-#     for i in range(0, len(sentences), 2):
-#         if i + 1 < len(sentences):
-#             sentences_combined.append(sentences[i] + sentences[i + 1])
-#         else:
-#             sentences_combined.append(sentences[i])
-    
-#     for sentence in sentences_combined:
-#         # Если текущее предложение само по себе слишком длинное, разбиваем его
-#         if len(sentence) > max_length:
-#             # Разбиваем длинное предложение на части
-#             words = sentence.split()
-#             temp_chunk = ""
-            
-#             for word in words:
-#                 if len(temp_chunk) + len(word) + 1 <= max_length:
-#                     if temp_chunk:
-#                         temp_chunk += " " + word
-#                     else:
-#                         temp_chunk = word
-#                 else:
-#                     if temp_chunk:
-#                         chunks.append(temp_chunk)
-#                     temp_chunk = word
-            
-#             if temp_chunk:
-#                 chunks.append(temp_chunk)
-#         else:
-#             # Обычное предложение
-#             if len(current_chunk) + len(sentence) <= max_length:
-#                 current_chunk += sentence
-#             else:
-#                 if current_chunk:
-#                     chunks.append(current_chunk.strip())
-#                 current_chunk = sentence
-    
-#     if current_chunk:
-#         chunks.append(current_chunk.strip())
-    
-#     return chunks
-
+import io
 import os
-import tempfile
+import shutil
+import uuid
 import speech_recognition as sr
 from aiogram import Router, F
 from aiogram.types import Message
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
 import logging
-import subprocess
-import hashlib
+import numpy as np
 import time
-from collections import defaultdict
 import re
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
 from aiogram.filters import Command
-from app.generate import ai_analyze_message, analyze_long_text, simple_text_analysis
+from app.generate import ai_analyze_message, analyze_long_text, simple_text_analysis, AI_DIRECT_MAX_CHARS, TRIVIAL_MAX_CHARS, RUSSIAN_ONLY
+
+# Google Cloud Speech - необязательная зависимость для длинных голосовых
+try:
+    from google.cloud import speech_v1, storage
+except ImportError:
+    speech_v1 = None
+    storage = None
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Путь к ffmpeg определяется один раз при импорте: из PATH, иначе стандартная установка под Windows
+FFMPEG_PATH = shutil.which('ffmpeg') or "C:\\ffmpeg\\ffmpeg-master-latest-win64-gpl-shared\\bin\\ffmpeg.exe"
+FFMPEG_OK = os.path.exists(FFMPEG_PATH)
+# Формат PCM, который выдает ffmpeg: моно, 16 бит, 16 кГц
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# Сегменты тише этого уровня считаются тишиной и не распознаются
+MIN_SEGMENT_DBFS = -55
+# Одновременных запросов к Google Speech для одного сообщения
+STT_CONCURRENCY = 4
+# Общий пул потоков для Google Speech - ограничивает нагрузку от всех пользователей сразу
+_stt_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='stt')
+
+# Один распознаватель на весь процесс: recognize_google для готовых AudioData не меняет его состояние
+_recognizer = sr.Recognizer()
+# Голосовые длиннее этого распознаются через Google Cloud целиком, без разбиения
+LONG_VOICE_SECONDS = 55
+GCS_BUCKET = os.getenv('GCS_BUCKET')
+
 # Кэш и ограничения
-text_cache = {}
-user_requests = defaultdict(list)
-last_ai_error = defaultdict(float)
+text_cache = OrderedDict()
+TEXT_CACHE_SIZE = 128
+user_buckets = {}
+# Корзина пользователя, не писавшего столько секунд, полная - ее можно не хранить
+BUCKET_IDLE_SECONDS = 600
+STATE_GC_INTERVAL = 600
+# Для интервалов ограничения частоты нужны только разности - монотонные часы не скачут при переводе времени
+_now = time.monotonic
+
+# Регулярные выражения для разбора ответа AI компилируются один раз
+_WS_RE = re.compile(r'\s+')
+_LABELS = ('ОСНОВНАЯ МЫСЛЬ:', 'ОТВЕТ:')
+_MAIN_LABEL, _ANSWER_LABEL = _LABELS
+_LABELS_RE = re.compile('|'.join(map(re.escape, _LABELS)))
+_SENT_RE = re.compile(r'([.!?]+\s*)')
+
+# Тексты команд не меняются - создаются один раз при импорте
+_WELCOME: Final[str] = "Привет! Рад тебя видеть. Как я могу помочь?"
+_HELP: Final[str] = "Просто отправьте мне текстовое или голосовое сообщение для анализа"
+_STATUS: Final[str] = "✅ Бот работает"
 
 @router.message(Command("start"))
 async def start_command(message: Message):
     """Обработка команды /start"""
-    welcome_text = "Привет! Рад тебя видеть. Как я могу помочь?"
-    await message.answer(welcome_text)
-    logger.info(f"✅ Обработана команда /start от пользователя {message.from_user.id}")
+    await message.answer(_WELCOME)
+    logger.info("✅ Обработана команда /start от пользователя %s", message.from_user.id)
 
 @router.message(Command("help"))
 async def help_command(message: Message):
     """Помощь по использованию бота"""
-    help_text = "Просто отправьте мне текстовое или голосовое сообщение для анализа"
-    await message.answer(help_text)
+    await message.answer(_HELP)
 
 @router.message(Command("status"))
 async def status_command(message: Message):
     """Показывает статус"""
-    await message.answer("✅ Бот работает")
+    await message.answer(_STATUS)
 
 # Остальные функции и обработчики...
 
+def clean_field(value: str) -> str:
+    """Убирает не-русские символы, схлопывает пробелы и затем убирает метки"""
+    # Сначала пробелы: метка с двойным пробелом или переносом внутри тоже должна найтись
+    return _LABELS_RE.sub('', _WS_RE.sub(' ', value.translate(RUSSIAN_ONLY))).strip()
+
+def cache_key(text: str) -> str:
+    """Ключ кэша: текст без учета регистра, лишних пробелов и точки в конце"""
+    # Остальная пунктуация несет смысл: "-5" и "5", "50%" и "50", вопрос и утверждение - разные тексты
+    return _WS_RE.sub(' ', text.lower()).strip().removesuffix('.').rstrip()
+
+def cache_get(key):
+    """Достает анализ из кэша и помечает запись как недавно использованную"""
+    analysis = text_cache.get(key)
+    if analysis is None:
+        return None
+    text_cache.move_to_end(key)
+    return analysis
+
+def cache_put(key, analysis: dict):
+    """Кладет анализ в кэш и вытесняет давно не использованные записи"""
+    text_cache[key] = analysis
+    text_cache.move_to_end(key)
+    if len(text_cache) > TEXT_CACHE_SIZE:
+        text_cache.popitem(last=False)
+
+def first_sentences(text: str, n: int) -> list:
+    """Первые n непустых предложений (до точки) без разбиения всего текста"""
+    sentences, rest = [], text
+    while len(sentences) < n:
+        head, sep, rest = rest.partition('.')
+        head = head.strip()
+        if head:
+            sentences.append(head)
+        if not sep:
+            break
+    return sentences
+
 def parse_analysis_response(response: str) -> dict:
     """Парсит ответ от AI на основную мысль и ответ с улучшенной обработкой"""
+    main_idea, answer = parse_cached(response)
+    return {"main_idea": main_idea, "answer": answer}
+
+@functools.lru_cache(maxsize=128)
+def parse_cached(response: str) -> tuple:
+    """Разбор ответа AI, кэшируется как неизменяемый кортеж (main_idea, answer)"""
     if not response:
-        return {
-            "main_idea": "Не удалось проанализировать сообщение", 
-            "answer": "Попробуйте отправить сообщение еще раз"
-        }
+        return "Не удалось проанализировать сообщение", "Попробуйте отправить сообщение еще раз"
     
     # Очищаем ответ
     response = response.strip()
-    
-    # Случай 1: Ищем стандартный формат с разделением по строкам
-    lines = response.split('\n')
     main_idea = ""
     answer = ""
     
-    for line in lines:
-        line = line.strip()
-        if line.startswith('ОСНОВНАЯ МЫСЛЬ:'):
-            main_idea = line.replace('ОСНОВНАЯ МЫСЛЬ:', '').strip()
-        elif line.startswith('ОТВЕТ:'):
-            answer = line.replace('ОТВЕТ:', '').strip()
-    
-    # Случай 2: Если нашли оба поля, но они в одной строке
-    if not answer and 'ОТВЕТ:' in response:
-        parts = response.split('ОТВЕТ:')
-        if len(parts) == 2:
-            main_part = parts[0]
-            if 'ОСНОВНАЯ МЫСЛЬ:' in main_part:
-                main_idea = main_part.split('ОСНОВНАЯ МЫСЛЬ:')[1].strip()
-            else:
-                main_idea = main_part.strip()
-            answer = parts[1].strip()
+    # Случай 1: Метки ищутся независимо - модель может поставить ОТВЕТ раньше ОСНОВНОЙ МЫСЛИ.
+    # Поле - текст от своей метки до другой метки (если та стоит дальше) или до конца
+    main_pos = response.find(_MAIN_LABEL)
+    answer_pos = response.find(_ANSWER_LABEL)
+    if main_pos >= 0:
+        end = answer_pos if answer_pos > main_pos else len(response)
+        main_idea = response[main_pos + len(_MAIN_LABEL):end].strip()
+    if answer_pos >= 0:
+        end = main_pos if main_pos > answer_pos else len(response)
+        answer = response[answer_pos + len(_ANSWER_LABEL):end].strip()
+        # Случай 2: Есть только метка ответа - основная мысль стоит перед ней
+        if main_pos < 0:
+            main_idea = response[:answer_pos].strip()
     
     # Случай 3: Если все еще не нашли, пытаемся разделить по другим признакам
     if not main_idea and not answer:
-        parts = response.split('\n\n')
-        if len(parts) >= 2:
-            main_idea = parts[0]
-            answer = parts[1]
+        if '\n\n' in response:
+            main_idea, answer = response.split('\n\n', 2)[:2]
         else:
-            sentences = [s.strip() for s in response.split('.') if s.strip()]
+            sentences = first_sentences(response, 5)
             if len(sentences) >= 2:
                 main_idea = '. '.join(sentences[:min(2, len(sentences))]) + '.'
                 remaining = sentences[min(2, len(sentences)):]
@@ -764,18 +170,9 @@ def parse_analysis_response(response: str) -> dict:
                 main_idea = response
                 answer = "Понимаю вашу ситуацию. Давайте обсудим это подробнее."
     
-    # Очищаем от возможных остатков не-русского текста
-    main_idea = re.sub(r'[^\u0400-\u04FF\s\.\,\!\?\-\:\(\)\d]', '', main_idea)
-    answer = re.sub(r'[^\u0400-\u04FF\s\.\,\!\?\-\:\(\)\d]', '', answer)
-    
-    # Удаляем лишние пробелы
-    main_idea = re.sub(r'\s+', ' ', main_idea).strip()
-    answer = re.sub(r'\s+', ' ', answer).strip()
-    
-    # Удаляем возможные остатки меток
-    for label in ['ОСНОВНАЯ МЫСЛЬ:', 'ОТВЕТ:']:
-        main_idea = main_idea.replace(label, '').strip()
-        answer = answer.replace(label, '').strip()
+    # Очищаем от не-русского текста и остатков меток, затем схлопываем пробелы
+    main_idea = clean_field(main_idea)
+    answer = clean_field(answer)
     
     # Проверяем, что поля не пустые
     if not main_idea:
@@ -789,133 +186,320 @@ def parse_analysis_response(response: str) -> dict:
     if len(answer) > 500:
         answer = answer[:497] + "..."
     
-    return {"main_idea": main_idea, "answer": answer}
-
-def can_make_ai_request(user_id: int) -> bool:
-    """Проверяет, можно ли делать запрос к AI"""
-    now = time.time()
-    
-    user_requests[user_id] = [req_time for req_time in user_requests[user_id] if now - req_time < 120]
-    if len(user_requests[user_id]) >= 3:
-        return False
-    
-    if now - last_ai_error.get(user_id, 0) < 300:
-        return False
-    
-    return True
-
-def add_request(user_id: int):
-    """Добавляет запрос в историю пользователя"""
-    user_requests[user_id].append(time.time())
+    return main_idea, answer
+
+class TokenBucket:
+    """Корзина токенов пользователя: 3 запроса, пополнение 3 токена за 2 минуты"""
+    __slots__ = ('tokens', 'last')
+    # Общие для всех пользователей параметры - атрибуты класса, а не экземпляра
+    cap = 3
+    rate = 3 / 120
+    
+    def __init__(self, now: float):
+        self.tokens = self.cap
+        self.last = now
+
+def get_bucket(user_id: int, now: float) -> TokenBucket:
+    """Возвращает корзину пользователя, пополненную на момент now"""
+    # Переставляем корзину в конец: словарь упорядочен по времени последнего обращения
+    bucket = user_buckets.pop(user_id, None)
+    if bucket is None:
+        bucket = TokenBucket(now)
+    else:
+        # Время, переданное из начала обработки, может оказаться раньше последнего обновления корзины
+        elapsed = max(now - bucket.last, 0)
+        bucket.tokens = min(bucket.cap, bucket.tokens + elapsed * bucket.rate)
+        bucket.last = max(bucket.last, now)
+    user_buckets[user_id] = bucket
+    evict_idle_buckets(now)
+    return bucket
+
+def evict_idle_buckets(now: float, limit: int = 2):
+    """Удаляет корзины неактивных пользователей с начала словаря (самые давние обращения)"""
+    # За BUCKET_IDLE_SECONDS корзина гарантированно восстанавливается до полной даже после штрафа,
+    # поэтому удаление ничем не отличается от новой корзины
+    for _ in range(limit):
+        oldest_id = next(iter(user_buckets), None)
+        if oldest_id is None or now - user_buckets[oldest_id].last <= BUCKET_IDLE_SECONDS:
+            break
+        del user_buckets[oldest_id]
+
+async def state_gc_loop():
+    """Фоновая очистка состояния пользователей, которые давно не пишут"""
+    while True:
+        await asyncio.sleep(STATE_GC_INTERVAL)
+        before = len(user_buckets)
+        # Корзины упорядочены по последнему обращению - проход останавливается на первой активной
+        evict_idle_buckets(_now(), limit=before)
+        if before > len(user_buckets):
+            logger.info("Удалено %s неактивных корзин лимита", before - len(user_buckets))
+
+def can_make_ai_request(user_id: int, now: float = None) -> bool:
+    """Проверяет, можно ли делать запрос к AI, и сразу списывает токен"""
+    bucket = get_bucket(user_id, now or _now())
+    if bucket.tokens >= 1:
+        bucket.tokens -= 1
+        return True
+    return False
 
 def mark_ai_error(user_id: int):
-    """Отмечает ошибку AI для пользователя"""
-    last_ai_error[user_id] = time.time()
-
-def split_audio_on_silence(audio_path, silence_thresh=-40, min_silence_len=1000, chunk_length=30000):
+    """Отмечает ошибку AI для пользователя: штраф уводит корзину в минус"""
+    # Время берется в момент ошибки: после долгой обработки штраф не должен сокращаться
+    bucket = get_bucket(user_id, _now())
+    bucket.tokens = -bucket.cap
+
+def split_long_text(text: str, max_length: int = 3900) -> list:
+    """Разбивает длинный текст на части для отправки в Telegram"""
+    if len(text) <= max_length:
+        return [text]
+    
+    chunks = []
+    # Части текущего фрагмента копим в списке и склеиваем один раз
+    buf = []
+    buf_len = 0
+    
+    # split с группой возвращает [предложение, разделитель, предложение, ...]
+    parts = _SENT_RE.split(text)
+    for i in range(0, len(parts), 2):
+        sentence = parts[i] + (parts[i + 1] if i + 1 < len(parts) else '')
+        if not sentence:
+            continue
+        
+        # Если предложение само по себе слишком длинное, разбиваем его по словам
+        if len(sentence) > max_length:
+            if buf:
+                chunks.append(''.join(buf).strip())
+                buf = []
+                buf_len = 0
+            
+            words = []
+            words_len = 0
+            for word in sentence.split():
+                extra = len(word) + (1 if words else 0)
+                if words_len + extra <= max_length:
+                    words.append(word)
+                    words_len += extra
+                else:
+                    if words:
+                        chunks.append(' '.join(words))
+                    words = [word]
+                    words_len = len(word)
+            if words:
+                chunks.append(' '.join(words))
+        else:
+            # Обычное предложение
+            if buf_len + len(sentence) > max_length:
+                chunks.append(''.join(buf).strip())
+                buf = []
+                buf_len = 0
+            buf.append(sentence)
+            buf_len += len(sentence)
+    
+    if buf:
+        chunks.append(''.join(buf).strip())
+    
+    return chunks
+
+def silencedetect_filter(silence_thresh=-40, min_silence_len=1000) -> str:
+    """Фильтр ffmpeg для поиска тишины с теми же параметрами, что и разбиение"""
+    return f"silencedetect=n={silence_thresh}dB:d={min_silence_len / 1000}"
+
+def parse_silencedetect(stderr: str) -> list:
+    """Извлекает интервалы тишины (start_ms, end_ms) из вывода ffmpeg silencedetect"""
+    silences = []
+    silence_start = None
+    
+    for kind, value in re.findall(r'silence_(start|end): (-?[\d.]+)', stderr):
+        ms = int(float(value) * 1000)
+        if kind == 'start':
+            silence_start = max(ms, 0)
+        elif silence_start is not None:
+            silences.append((silence_start, ms))
+            silence_start = None
+    
+    # Тишина до самого конца записи может остаться без silence_end
+    if silence_start is not None:
+        silences.append((silence_start, None))
+    
+    return silences
+
+def get_pcm_duration_ms(pcm: bytes) -> int:
+    """Длительность моно PCM в миллисекундах"""
+    return len(pcm) // SAMPLE_WIDTH * 1000 // SAMPLE_RATE
+
+def segment_dbfs(samples, start_ms, end_ms) -> float:
+    """Средняя громкость сегмента в dBFS"""
+    segment = samples[start_ms * SAMPLE_RATE // 1000:end_ms * SAMPLE_RATE // 1000]
+    if not len(segment):
+        return float('-inf')
+    mean_square = np.mean(segment.astype(np.float64) ** 2)
+    if mean_square == 0:
+        return float('-inf')
+    return 10 * np.log10(mean_square) - 20 * np.log10(32768)
+
+def drop_silent_segments(pcm: bytes, chunks, min_dbfs=MIN_SEGMENT_DBFS) -> list:
+    """Отбрасывает почти беззвучные сегменты, чтобы не тратить на них запросы к Google"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    voiced = [(start_ms, end_ms) for start_ms, end_ms in chunks
+              if segment_dbfs(samples, start_ms, end_ms) >= min_dbfs]
+    
+    if len(voiced) < len(chunks):
+        logger.info("Пропущено %s беззвучных сегментов", len(chunks) - len(voiced))
+    return voiced
+
+def split_audio_on_silence(pcm: bytes, silences, chunk_length=30000, keep_silence=500):
     """
-    Разбивает аудио на сегменты по тишине или по времени
+    Разбивает аудио на сегменты (start_ms, end_ms) по тишине или по времени.
+    Тишину находит ffmpeg silencedetect в том же проходе, что и конвертация.
     """
+    duration = get_pcm_duration_ms(pcm)
+    
+    # Если аудио короткое, возвращаем как есть
+    if duration <= 45000:  # 45 секунд
+        return [(0, duration)]
+    
+    # Сегменты речи - промежутки между интервалами тишины
+    chunks = []
+    position = 0
+    for silence_start, silence_end in silences:
+        if silence_end is None:
+            silence_end = duration
+        if silence_start > position:
+            # Оставляем немного тишины по краям для естественности
+            chunks.append((max(position - keep_silence, 0), min(silence_start + keep_silence, duration)))
+        position = max(position, silence_end)
+    if position < duration:
+        chunks.append((max(position - keep_silence, 0), duration))
+    
+    # Если разбиение по тишине не дало результатов или слишком много/мало чанков,
+    # разбиваем по фиксированному времени
+    if not chunks or len(chunks) > 20 or len(chunks) < 2:
+        chunks = []
+        for i in range(0, duration, chunk_length):
+            end = min(i + chunk_length, duration)
+            if end - i > 1000:  # Минимальная длина чанка 1 секунда
+                chunks.append((i, end))
+    
+    logger.info("Аудио разбито на %s сегментов, общая длительность: %sмс", len(chunks), duration)
+    return drop_silent_segments(pcm, chunks)
+
+async def run_stt(audio_data) -> str:
+    """Запускает блокирующий recognize_google в общем пуле потоков распознавания"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _stt_executor, functools.partial(_recognizer.recognize_google, audio_data, language='ru-RU')
+    )
+
+async def recognize_segment(index, total, full_audio, start_ms, end_ms, semaphore) -> str:
+    """Распознает один сегмент в отдельном потоке, не блокируя цикл событий"""
+    async with semaphore:
+        # Байты сегмента копируются только перед отправкой - одновременно в памяти не больше STT_CONCURRENCY копий
+        audio_data = full_audio.get_segment(start_ms, end_ms)
+        try:
+            segment_text = await run_stt(audio_data)
+        except sr.UnknownValueError:
+            logger.warning("Не удалось распознать сегмент %s", index+1)
+            return ""
+    
+    if segment_text:
+        logger.info("Сегмент %s/%s распознан: %s...", index+1, total, segment_text[:50])
+    else:
+        logger.warning("Сегмент %s не распознан", index+1)
+    return segment_text or ""
+
+def google_cloud_available() -> bool:
+    """Проверяет, настроен ли Google Cloud Speech (библиотеки и бакет для загрузки)"""
+    return speech_v1 is not None and storage is not None and bool(GCS_BUCKET)
+
+@functools.lru_cache(maxsize=None)
+def gcs_bucket():
+    """Бакет для загрузки аудио - клиент создается один раз (чтение учетных данных блокирует)"""
+    return storage.Client().bucket(GCS_BUCKET)
+
+@functools.lru_cache(maxsize=None)
+def speech_client():
+    """Клиент Google Cloud Speech, общий для всех запросов"""
+    return speech_v1.SpeechClient()
+
+async def recognize_long_google_cloud(pcm: bytes) -> str:
+    """Распознает длинное аудио одним запросом LongRunningRecognize (до 480 минут)"""
+    blob_name = f"voice/{uuid.uuid4().hex}.pcm"
+    bucket = await asyncio.to_thread(gcs_bucket)
+    blob = bucket.blob(blob_name)
+    await asyncio.to_thread(blob.upload_from_string, pcm)
+    
     try:
-        # Загружаем аудио
-        audio = AudioSegment.from_wav(audio_path)
-        duration = len(audio)
-        
-        # Если аудио короткое, возвращаем как есть
-        if duration <= 45000:  # 45 секунд
-            return [audio]
-        
-        # Сначала пытаемся разбить по тишине
-        chunks = split_on_silence(
-            audio,
-            min_silence_len=min_silence_len,
-            silence_thresh=silence_thresh,
-            keep_silence=500  # Оставляем немного тишины для естественности
+        client = await asyncio.to_thread(speech_client)
+        config = speech_v1.RecognitionConfig(
+            encoding=speech_v1.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=SAMPLE_RATE,
+            language_code='ru-RU',
+            enable_automatic_punctuation=True,
         )
-        
-        # Если разбиение по тишине не дало результатов или слишком много/мало чанков,
-        # разбиваем по фиксированному времени
-        if not chunks or len(chunks) > 20 or len(chunks) < 2:
-            chunks = []
-            for i in range(0, duration, chunk_length):
-                chunk = audio[i:i + chunk_length]
-                if len(chunk) > 1000:  # Минимальная длина чанка 1 секунда
-                    chunks.append(chunk)
-        
-        logger.info(f"Аудио разбито на {len(chunks)} сегментов, общая длительность: {duration}мс")
-        return chunks
-        
-    except Exception as e:
-        logger.error(f"Ошибка при разбиении аудио: {e}")
-        # В случае ошибки возвращаем весь файл как один чанк
-        return [AudioSegment.from_wav(audio_path)]
+        audio = speech_v1.RecognitionAudio(uri=f"gs://{GCS_BUCKET}/{blob_name}")
+        operation = await asyncio.to_thread(client.long_running_recognize, config=config, audio=audio)
+        response = await asyncio.to_thread(operation.result, timeout=600)
+    finally:
+        await asyncio.to_thread(blob.delete)
+    
+    return " ".join(
+        result.alternatives[0].transcript for result in response.results if result.alternatives
+    ).strip()
 
-async def recognize_long_audio(wav_filename):
-    """Распознает длинные аудио файлы, разбивая их на сегменты"""
-    recognizer = sr.Recognizer()
-    full_text = ""
+async def recognize_long_audio(pcm: bytes, silences):
+    """Распознает длинные аудио, разбивая их на сегменты"""
+    # PCM уже в памяти - сегменты вырезаются из него без файлов и перекодирования
+    full_audio = sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
     
     try:
-        # Разбиваем аудио на сегменты
-        chunks = split_audio_on_silence(wav_filename)
+        # Разбиваем аудио на сегменты (оценка громкости в numpy - вне цикла событий)
+        chunks = await asyncio.to_thread(split_audio_on_silence, pcm, silences)
         
         if len(chunks) > 1:
-            logger.info(f"Обрабатываю {len(chunks)} сегментов аудио")
+            logger.info("Обрабатываю %s сегментов аудио", len(chunks))
+        
+        # Сегменты отправляем в Google параллельно, но не больше STT_CONCURRENCY одновременно
+        semaphore = asyncio.Semaphore(STT_CONCURRENCY)
+        results = await asyncio.gather(
+            *[recognize_segment(i, len(chunks), full_audio, start_ms, end_ms, semaphore)
+              for i, (start_ms, end_ms) in enumerate(chunks)],
+            return_exceptions=True
+        )
         
-        for i, chunk in enumerate(chunks):
-            # Создаем временный файл для сегмента
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'_segment_{i}.wav') as segment_file:
-                segment_filename = segment_file.name
-            
-            # Экспортируем сегмент
-            chunk.export(segment_filename, format="wav")
-            
-            try:
-                # Распознаем сегмент
-                with sr.AudioFile(segment_filename) as source:
-                    recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                    audio_data = recognizer.record(source)
-                    segment_text = recognizer.recognize_google(audio_data, language='ru-RU')
-                    
-                    if segment_text:
-                        full_text += segment_text + " "
-                        logger.info(f"Сегмент {i+1}/{len(chunks)} распознан: {segment_text[:50]}...")
-                    else:
-                        logger.warning(f"Сегмент {i+1} не распознан")
-                        
-            except sr.UnknownValueError:
-                logger.warning(f"Не удалось распознать сегмент {i+1}")
-            except Exception as e:
-                logger.error(f"Ошибка при распознавании сегмента {i+1}: {e}")
-            finally:
-                # Удаляем временный файл сегмента
-                if os.path.exists(segment_filename):
-                    os.unlink(segment_filename)
+        # gather сохраняет порядок сегментов
+        texts = []
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error("Ошибка при распознавании сегмента %s: %s", i+1, result)
+            elif result:
+                texts.append(result)
         
-        return full_text.strip()
+        return " ".join(texts)
         
     except Exception as e:
-        logger.error(f"Ошибка при распознавании длинного аудио: {e}")
+        logger.error("Ошибка при распознавании длинного аудио: %s", e)
         # Пробуем распознать как обычное короткое аудио
         try:
-            with sr.AudioFile(wav_filename) as source:
-                recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                audio_data = recognizer.record(source)
-                return recognizer.recognize_google(audio_data, language='ru-RU')
+            return await run_stt(full_audio)
         except:
             return ""
 
+async def send_analysis(message: Message, analysis: dict):
+    """Отправляет основную мысль и готовый ответ одним сообщением"""
+    # Оба поля обрезаются разбором до 500 символов - вместе они всегда влезают в лимит Telegram
+    await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}\n\n💬 **Готовый ответ для отправки:**\n{analysis['answer']}")
+
 @router.message(F.voice)
 async def handle_voice_message(message: Message):
     """Обработка голосовых сообщений с поддержкой длинных записей"""
     user_id = message.from_user.id
+    # Одно чтение часов на сообщение - для проверки лимита
+    now = _now()
     
-    if not can_make_ai_request(user_id):
+    if not can_make_ai_request(user_id, now):
         await message.answer("⏳ Слишком много запросов. Подождите 2-3 минуты.")
         return
     
-    add_request(user_id)
-    
     # Проверяем длину голосового сообщения
     voice_duration = message.voice.duration
     if voice_duration > 120:
@@ -923,122 +507,120 @@ async def handle_voice_message(message: Message):
     else:
         await message.answer("🎤 Обрабатываю голосовое сообщение...")
     
-    ogg_filename = None
-    wav_filename = None
-    
     try:
-        voice = message.voice
-        file = await message.bot.get_file(voice.file_id)
-        file_path = file.file_path
+        # Скачиваем файл в память: bot.download сам получает путь к файлу и использует сессию бота
+        ogg_buffer = await message.bot.download(message.voice, destination=io.BytesIO())
+        ogg_bytes = ogg_buffer.getvalue()
         
-        # Создаем временные файлы
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as ogg_file:
-            ogg_filename = ogg_file.name
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as wav_file:
-            wav_filename = wav_file.name
-        
-        # Скачиваем файл
-        await message.bot.download_file(file_path, ogg_filename)
-        
-        if not os.path.exists(ogg_filename) or os.path.getsize(ogg_filename) == 0:
+        if not ogg_bytes:
             await message.answer("❌ Не удалось скачать голосовое сообщение")
             return
         
-        # Конвертируем OGG в WAV
-        ffmpeg_path = "C:\\ffmpeg\\ffmpeg-master-latest-win64-gpl-shared\\bin\\ffmpeg.exe"
-        
-        if not os.path.exists(ffmpeg_path):
+        # Конвертируем OGG в PCM через stdin/stdout ffmpeg и в том же проходе ищем тишину
+        if not FFMPEG_OK:
             await message.answer("❌ FFmpeg не найден")
             return
         
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH,
+            '-i', 'pipe:0',
+            '-f', 's16le',
+            '-acodec', 'pcm_s16le',
+            '-ac', '1',
+            '-ar', str(SAMPLE_RATE),
+            '-af', f'volume=1.5,highpass=f=200,lowpass=f=3000,{silencedetect_filter()}',
+            'pipe:1',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
         try:
-            result = subprocess.run([
-                ffmpeg_path,
-                '-i', ogg_filename,
-                '-acodec', 'pcm_s16le',
-                '-ac', '1',
-                '-ar', '16000',
-                '-af', 'volume=1.5,highpass=f=200,lowpass=f=3000',
-                wav_filename,
-                '-y'
-            ], capture_output=True, text=True, timeout=60)
-            
-            if result.returncode != 0:
-                await message.answer("❌ Ошибка конвертации аудио")
-                return
-                
-        except subprocess.TimeoutExpired:
+            pcm, stderr = await asyncio.wait_for(process.communicate(ogg_bytes), timeout=60)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
             await message.answer("❌ Таймаут конвертации аудио")
             return
         
-        # Проверяем что WAV файл создан
-        if not os.path.exists(wav_filename) or os.path.getsize(wav_filename) == 0:
+        if process.returncode != 0:
+            await message.answer("❌ Ошибка конвертации аудио")
+            return
+        
+        # Проверяем что ffmpeg вернул звук
+        if not pcm:
             await message.answer("❌ Не удалось конвертировать аудио")
             return
         
-        # Распознаем аудио
-        text = await recognize_long_audio(wav_filename)
+        silences = parse_silencedetect(stderr.decode('utf-8', 'ignore'))
+        
+        # Распознаем аудио: длинные - целиком в Google Cloud, если он настроен
+        text = ""
+        if voice_duration > LONG_VOICE_SECONDS and google_cloud_available():
+            try:
+                text = await recognize_long_google_cloud(pcm)
+            except Exception as e:
+                logger.warning("Google Cloud Speech недоступен, распознаю по частям: %s", e)
+        
+        if not text:
+            text = await recognize_long_audio(pcm, silences)
         
         if not text or len(text.strip()) < 5:
             await message.answer("❌ Не удалось распознать речь в сообщении")
             return
         
         text_length = len(text)
-        await message.answer(f"📝 Распознанный текст ({text_length} символов):\n{text}")
         
-        # Проверяем кэш
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        if text_hash in text_cache:
-            analysis = text_cache[text_hash]
+        # Длинный текст не влезает в одно сообщение Telegram - отправляем частями
+        if text_length > 4000:
+            chunks = split_long_text(text)
+            await message.answer(f"📝 Распознанный текст ({text_length} символов, отправляется {len(chunks)} частями):")
+            for i, chunk in enumerate(chunks):
+                await message.answer(f"**Часть {i+1}/{len(chunks)}:**\n{chunk}")
+        else:
+            await message.answer(f"📝 Распознанный текст ({text_length} символов):\n{text}")
+        
+        # Короткую фразу разбираем локально - без хеша, кэша и запроса к AI (порог общий с ai_analyze_message)
+        if len(text.strip()) < TRIVIAL_MAX_CHARS:
+            await send_analysis(message, parse_analysis_response(await simple_text_analysis(text)))
+            return
+        
+        # Проверяем кэш: тот же текст с другим регистром или пробелами дает тот же ключ
+        key = cache_key(text)
+        analysis = cache_get(key)
+        if analysis is not None:
             await message.answer("♻️ Использую кэшированный результат")
         else:
             # Пытаемся использовать AI для анализа
             try:
-                from generate import ai_analyze_message, analyze_long_text, simple_text_analysis
-                
-                # Выбираем метод анализа в зависимости от длины текста
-                if text_length > 4000:
+                # По частям анализируем только то, что не помещается в один запрос к модели
+                if text_length > AI_DIRECT_MAX_CHARS:
                     await message.answer("📖 Текст длинный, анализирую по частям...")
                     analysis_response = await analyze_long_text(text)
                 else:
                     analysis_response = await ai_analyze_message(text)
                 
                 # Логируем сырой ответ от AI для отладки
-                logger.info(f"Сырой ответ от AI: {analysis_response}")
+                logger.info("Сырой ответ от AI: %s", analysis_response)
                 
                 analysis = parse_analysis_response(analysis_response)
-                text_cache[text_hash] = analysis
+                cache_put(key, analysis)
                 
-                # Очищаем старые записи кэша
-                if len(text_cache) > 50:
-                    oldest_key = next(iter(text_cache))
-                    text_cache.pop(oldest_key)
-                    
             except Exception as e:
-                logger.error(f"AI анализ не удался: {e}")
+                logger.error("AI анализ не удался: %s", e)
                 mark_ai_error(user_id)
                 # Используем резервный анализ
-                from generate import simple_text_analysis
                 backup_response = await simple_text_analysis(text)
                 analysis = parse_analysis_response(backup_response)
                 await message.answer("⚠️ Использую локальный анализ (AI временно недоступен)")
         
-        # Сначала отправляем основную мысль
-        await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-        
-        # Затем отправляем заголовок "Готовый ответ для отправки"
-        await message.answer("💬 **Готовый ответ для отправки:**")
-        
-        # Затем отправляем сам ответ отдельным сообщением
-        await message.answer(analysis['answer'])
+        await send_analysis(message, analysis)
         
     except sr.RequestError as e:
         await message.answer("❌ Ошибка сервиса распознавания речи.")
-        logger.error(f"Speech recognition error: {e}")
+        logger.error("Speech recognition error: %s", e)
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Voice processing error: {e}")
+        logger.error("Voice processing error: %s", e)
         
         if "429" in error_msg or "rate" in error_msg.lower():
             mark_ai_error(user_id)
@@ -1047,40 +629,34 @@ async def handle_voice_message(message: Message):
             mark_ai_error(user_id)
             await message.answer("❌ Сервис AI временно недоступен. Использую локальный анализ.")
             try:
-                from generate import simple_text_analysis
                 backup_response = await simple_text_analysis(text)
                 analysis = parse_analysis_response(backup_response)
-                await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-                await message.answer("💬 **Готовый ответ для отправки:**")
-                await message.answer(analysis['answer'])
+                await send_analysis(message, analysis)
             except:
                 await message.answer("❌ Не удалось обработать сообщение.")
         else:
             await message.answer(f"❌ Ошибка обработки: {error_msg}")
-    finally:
-        # Удаляем временные файлы
-        for filename in [ogg_filename, wav_filename]:
-            if filename and os.path.exists(filename):
-                try:
-                    os.unlink(filename)
-                except Exception as e:
-                    logger.warning(f"Не удалось удалить файл {filename}: {e}")
 
 @router.message(F.text & ~F.command)
 async def handle_text_message(message: Message):
     """Обработка текстовых сообщений с поддержкой длинных текстов"""
     user_id = message.from_user.id
+    # Одно чтение часов на сообщение - для проверки лимита
+    now = _now()
     text = message.text
     
     # Игнорируем команды, которые уже обработаны другими хендлерами
     if text.startswith('/'):
         return
     
-    if not can_make_ai_request(user_id):
-        await message.answer("⏳ Слишком много запросов. Подождите 2-3 минуты.")
+    # Короткую фразу разбираем локально - AI не нужен, лимит запросов не тратится
+    if len(text.strip()) < TRIVIAL_MAX_CHARS:
+        await send_analysis(message, parse_analysis_response(await simple_text_analysis(text)))
         return
     
-    add_request(user_id)
+    if not can_make_ai_request(user_id, now):
+        await message.answer("⏳ Слишком много запросов. Подождите 2-3 минуты.")
+        return
     
     text_length = len(text)
     
@@ -1090,48 +666,38 @@ async def handle_text_message(message: Message):
         await message.answer("🤔 Анализирую текст...")
     
     try:
-        # Проверяем кэш
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        if text_hash in text_cache:
-            analysis = text_cache[text_hash]
+        # Проверяем кэш: тот же текст с другим регистром или пробелами дает тот же ключ
+        key = cache_key(text)
+        analysis = cache_get(key)
+        if analysis is not None:
             await message.answer("♻️ Использую кэшированный результат")
         else:
             # Пытаемся использовать AI для анализа
             try:
-                from generate import ai_analyze_message, analyze_long_text, simple_text_analysis
-                
-                # Выбираем метод анализа в зависимости от длины текста
-                if text_length > 4000:
+                # По частям анализируем только то, что не помещается в один запрос к модели
+                if text_length > AI_DIRECT_MAX_CHARS:
                     analysis_response = await analyze_long_text(text)
                 else:
                     analysis_response = await ai_analyze_message(text)
                 
                 # Логируем сырой ответ от AI для отладки
-                logger.info(f"Сырой ответ от AI (текст): {analysis_response}")
+                logger.info("Сырой ответ от AI (текст): %s", analysis_response)
                 
                 analysis = parse_analysis_response(analysis_response)
-                text_cache[text_hash] = analysis
+                cache_put(key, analysis)
             except Exception as e:
-                logger.error(f"AI анализ не удался: {e}")
+                logger.error("AI анализ не удался: %s", e)
                 mark_ai_error(user_id)
                 # Используем резервный анализ
-                from generate import simple_text_analysis
                 backup_response = await simple_text_analysis(text)
                 analysis = parse_analysis_response(backup_response)
                 await message.answer("⚠️ Использую локальный анализ (AI временно недоступен)")
         
-        # Сначала отправляем основную мысль
-        await message.answer(f"🎯 **Основная мысль:**\n{analysis['main_idea']}")
-        
-        # Затем отправляем заголовок "Готовый ответ для отправки"
-        await message.answer("💬 **Готовый ответ для отправки:**")
-        
-        # Затем отправляем сам ответ отдельным сообщением
-        await message.answer(analysis['answer'])
+        await send_analysis(message, analysis)
         
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Text processing error: {e}")
+        logger.error("Text processing error: %s", e)
         
         if "429" in error_msg or "rate" in error_msg.lower():
             mark_ai_error(user_id)
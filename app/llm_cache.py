@@ -0,0 +1,34 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class LLMCache:
+    """Кэш ответов модели в памяти: LRU с ограничением размера и временем жизни записей"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def get(self, key: str):
+        """Возвращает сохраненный ответ или None, если его нет или он устарел"""
+        async with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str, ttl: float = None):
+        """Сохраняет ответ и вытесняет давно не использованные записи"""
+        async with self._lock:
+            self._items[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
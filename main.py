@@ -1,30 +1,87 @@
 # TG_TOKEN = os.getenv('8212268365:AAHB5JcBUxK_HrsykkMbtE4cFHOiNu34uWA', 0)
 
 from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
-from app.handlers_analyzer import router as analyzer_router
+from app.handlers_analyzer import router as analyzer_router, state_gc_loop
+from app.generate import warm_up_client
 
 import logging
 import os
+import secrets
+import sys
 import asyncio
 
 logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
 TG_TOKEN = os.getenv('TG_TOKEN', 0)
+# Если задан адрес вебхука, Telegram сам присылает обновления - без постоянного опроса
+WEBHOOK_URL = os.getenv('TG_WEBHOOK_URL')
+WEBHOOK_PATH = '/tg'
+WEBHOOK_PORT = int(os.getenv('TG_WEBHOOK_PORT', '8080'))
+# Telegram присылает секрет в заголовке каждого запроса - чужие запросы на WEBHOOK_PATH отклоняются.
+# Если секрет не задан, он генерируется при запуске: вебхук все равно ставится заново
+WEBHOOK_SECRET = os.getenv('TG_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Принимает обновления через вебхук на встроенном aiohttp-сервере"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logging.info("Вебхук установлен: %s", WEBHOOK_URL)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Снимаем вебхук до закрытия сессии бота, иначе следующий запуск в режиме опроса получит конфликт
+        await bot.delete_webhook()
+        await runner.cleanup()
 
 async def main():
+    # Без токена бот не запустится - сообщаем сразу, а не ошибкой из глубины aiogram
+    if not TG_TOKEN:
+        raise SystemExit("TG_TOKEN не задан")
     bot = Bot(token=TG_TOKEN)
     dp = Dispatcher()
     
     # Включаем роутер анализатора
     dp.include_router(analyzer_router)
     
-    await dp.start_polling(bot)
+    # Прогреваем соединение с AI API до первых сообщений
+    await warm_up_client()
+    
+    # Периодически чистим состояние неактивных пользователей
+    gc_task = asyncio.create_task(state_gc_loop())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(bot, dp)
+        else:
+            # Оставшийся от режима вебхука адрес не дает получать обновления опросом
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        gc_task.cancel()
+
+def run(coro):
+    """Запускает корутину на цикле событий uvloop, если он установлен (на Windows его нет), иначе на стандартном"""
+    if sys.platform != 'win32':
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            return uvloop.run(coro)
+    return asyncio.run(coro)
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         print('Exit')
 